@@ -2,8 +2,11 @@
 # Based on information from:
 # https://www.kernel.org/doc/Documentation/input/joystick-api.txt
 
-import concurrent.futures
+import asyncio
+import atexit
 import logging
+import logging.handlers
+import math
 import queue
 import random
 import threading
@@ -14,24 +17,48 @@ import os, struct, array, signal
 from fcntl import ioctl
 
 import argparse
+from dataclasses import dataclass, field
 from py_overdrive_sdk.py_overdrive import Overdrive
 
+# python-evdev is optional, only needed for /dev/input/event* devices
+try:
+    import evdev
+    from evdev import ecodes
+except ImportError:
+    evdev = None
+
 # parse input
 parser = argparse.ArgumentParser()
 parser.add_argument("--car", help="id of the bluetooth car")
-parser.add_argument("--js", help="joystick device")
+parser.add_argument("--js", help="joystick device (/dev/input/js* or, with python-evdev, /dev/input/event*)")
 parser.add_argument("--host", help="host of the node gateway for bluetooth communication", default='127.0.0.1')
 parser.add_argument("--port", help="port of the node gateway for bluetooth communication", type=int, default=8005)
 args = parser.parse_args()
 
+# Log through a queue so the actual write to stdout happens on the listener thread,
+# not on the input path.
+log_queue = queue.SimpleQueue()
+logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+log_listener.start()
+atexit.register(log_listener.stop)
+log = logging.getLogger(__name__)
+
 # Iterate over the joystick devices.
-print('Available devices:')
+log.info('Available devices:')
 
 for fn in os.listdir('/dev/input'):
-    if fn.startswith('js'):
-        print('  /dev/input/%s' % (fn))
+    if fn.startswith('js') or (evdev and fn.startswith('event')):
+        log.info('  /dev/input/%s', fn)
 
-sys.stdout.flush()
+# js_event layout: u32 time, s16 value, u8 type, u8 number
+EV_STRUCT = struct.Struct('IhBB')
+EV_UNPACK = EV_STRUCT.iter_unpack
+# read up to 64 pending events per syscall
+READ_SIZE = EV_STRUCT.size * 64
+# js_event axis value (s16) -> normalised float, indexed by value + 32768
+AXIS_LUT = array.array('d', (i / 32767.0 for i in range(-32768, 32768)))
 
 # We'll store the states here.
 axis_states = {}
@@ -109,207 +136,386 @@ button_names = {
     0x2c3 : 'dpad_down',
 }
 
-axis_map = []
-button_map = []
+# Module-level scratch buffers for the joystick ioctls
+js_scratch = bytearray(400)
+js_name_buf = bytearray(128)
+
+def read_js_maps(jsdev):
+    """ Query name, axis map and button map of an open joystick device through ioctl """
+    ioctl(jsdev, 0x80006a13 + (0x10000 * len(js_name_buf)), js_name_buf) # JSIOCGNAME(len)
+    js_name = js_name_buf.rstrip(b'\x00').decode('utf-8')
+
+    # Get number of axes and buttons.
+    ioctl(jsdev, 0x80016a11, js_scratch) # JSIOCGAXES
+    num_axes = js_scratch[0]
+    ioctl(jsdev, 0x80016a12, js_scratch) # JSIOCGBUTTONS
+    num_buttons = js_scratch[0]
+
+    # Get the axis map (u8 codes).
+    ioctl(jsdev, 0x80406a32, js_scratch) # JSIOCGAXMAP
+    axis_map = [axis_names.get(axis, 'unknown(0x%02x)' % axis) for axis in js_scratch[:num_axes]]
+
+    # Get the button map (u16 codes).
+    ioctl(jsdev, 0x80406a34, js_scratch) # JSIOCGBTNMAP
+    button_map = [button_names.get(btn, 'unknown(0x%03x)' % btn)
+                  for btn in struct.unpack_from('%dH' % num_buttons, js_scratch)]
+
+    return js_name, axis_map, button_map
+
+def read_evdev_maps(dev):
+    """ Query axes (code -> name, min, range) and buttons (code -> name) of an evdev device """
+    caps = dev.capabilities()
+    evdev_axes = {}
+    for code, absinfo in caps.get(ecodes.EV_ABS, []):
+        axis_name = axis_names.get(code, 'unknown(0x%02x)' % code)
+        evdev_axes[code] = (sys.intern(axis_name), absinfo.min, (absinfo.max - absinfo.min) or 1)
+    evdev_buttons = {code: sys.intern(button_names.get(code, 'unknown(0x%03x)' % code))
+                     for code in caps.get(ecodes.EV_KEY, [])}
+    return dev.name, evdev_axes, evdev_buttons
 
 # Open the joystick device.
 fn = args.js
-print('Opening %s...' % fn)
-sys.stdout.flush()
-jsdev = open(fn, 'rb')
-
-# Get the device name.
-#buf = bytearray(63)
-buf = array.array('B', [0] * 64)
-ioctl(jsdev, 0x80006a13 + (0x10000 * len(buf)), buf) # JSIOCGNAME(len)
-js_name = buf.tobytes().rstrip(b'\x00').decode('utf-8')
-print('Device name: %s' % js_name)
-sys.stdout.flush()
-
-# Get number of axes and buttons.
-buf = array.array('B', [0])
-ioctl(jsdev, 0x80016a11, buf) # JSIOCGAXES
-num_axes = buf[0]
-
-buf = array.array('B', [0])
-ioctl(jsdev, 0x80016a12, buf) # JSIOCGBUTTONS
-num_buttons = buf[0]
-
-# Get the axis map.
-buf = array.array('B', [0] * 0x40)
-ioctl(jsdev, 0x80406a32, buf) # JSIOCGAXMAP
-
-for axis in buf[:num_axes]:
-    axis_name = axis_names.get(axis, 'unknown(0x%02x)' % axis)
-    axis_map.append(axis_name)
+log.info('Opening %s...', fn)
+if fn.startswith('/dev/input/event'):
+    if evdev is None:
+        log.error('python-evdev is required for %s', fn)
+        sys.exit(1)
+    # evdev uses the same ABS_*/BTN_* codes as the joydev maps above
+    jsdev = evdev.InputDevice(fn)
+    js_fd = jsdev.fd
+    js_name, evdev_axes, evdev_buttons = read_evdev_maps(jsdev)
+    axis_map = [axis_name for axis_name, _, _ in evdev_axes.values()]
+    button_map = list(evdev_buttons.values())
+else:
+    # opened once, non-blocking: the same fd serves the ioctls below and the event loop
+    jsdev = os.open(fn, os.O_RDONLY | os.O_NONBLOCK)
+    js_fd = jsdev
+    js_name, axis_map, button_map = read_js_maps(jsdev)
+log.info('Device name: %s', js_name)
+
+for axis_name in axis_map:
     axis_states[axis_name] = 0.0
-
-# Get the button map.
-buf = array.array('H', [0] * 200)
-ioctl(jsdev, 0x80406a34, buf) # JSIOCGBTNMAP
-
-for btn in buf[:num_buttons]:
-    btn_name = button_names.get(btn, 'unknown(0x%03x)' % btn)
-    button_map.append(btn_name)
+for btn_name in button_map:
     button_states[btn_name] = 0
 
-print('%d axes found: %s' % (num_axes, ', '.join(axis_map)))
-print('%d buttons found: %s' % (num_buttons, ', '.join(button_map)))
-
-sys.stdout.flush()
-
-car = None
-
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+# Freeze the maps into tuples of interned names: the hot path indexes them per event and
+# the resulting names are compared/hashed against the (interned) literal handler keys.
+axis_map = tuple(sys.intern(s) for s in axis_map)
+button_map = tuple(sys.intern(s) for s in button_map)
+
+log.info('%d axes found: %s', len(axis_map), ', '.join(axis_map))
+log.info('%d buttons found: %s', len(button_map), ', '.join(button_map))
+
+# minimum time between two commands sent to the node gateway (seconds), i.e. at most 30 Hz
+MIN_TX_INTERVAL = 1 / 30
+# period of the control tick recomputing speed/lane (seconds)
+TICK_INTERVAL = 0.02
+# time constants (seconds) of the speed ramps, integrated over the real elapsed time so the ramp
+# does not depend on the tick or joystick event rate: 1/4 (accel) and 1/3 (decel) of the way
+# every 0.2s, as the original polling loop did
+TAU_ACCEL = -0.2 / math.log(1 - 1 / 4)
+TAU_DECEL = -0.2 / math.log(1 - 1 / 3)
+# lane offset change rate (mm/s) and limit (mm)
+LANE_RATE = 30.0 / 0.2
+LANE_LIMIT = 120.0
+
+
+@dataclass
+class DriveState:
+    """ Driving state shared by the joystick handlers and the control loop """
+    car: Overdrive = None
+    current_speed: float = 400
+    current_lane: float = 0.0
+    max_speed: int = 3000
+    accelerate: bool = False
+    decelerate: bool = False
+    left: bool = False
+    right: bool = False
+    # single-slot mailbox (latest wins) of the (speed, lane) the commander thread should send
+    desired: tuple = (400, 0)
+    desired_ev: threading.Event = field(default_factory=threading.Event)
+    last_tick: float = field(default_factory=time.monotonic)
+    stop_event: asyncio.Event = None
+
+
+# Button handlers
+def _do_accel(state):
+    state.accelerate = True
+    state.decelerate = False
+
+def _do_decel(state):
+    state.accelerate = False
+    state.decelerate = True
+
+def _do_exit(state):
+    log.info("Exiting due to keypress. Disconnecting car")
+    state.stop_event.set()
+
+def _release_accel(state):
+    state.accelerate = False
+    state.decelerate = True
+
+def _release_decel(state):
+    state.accelerate = False
+    state.decelerate = True
+
+# Axis handlers
+def _on_x(fvalue, state):
+    if fvalue <= -1.0:
+        state.left = True
+        state.right = False
+    elif fvalue >= 1.0:
+        state.right = True
+        state.left = False
+
+def _on_y(fvalue, state):
+    if fvalue >= 0.9:
+        log.debug("DOWN")
+        state.accelerate = False
+        state.decelerate = True
+    elif fvalue <= -0.9:
+        log.debug("UP")
+        state.accelerate = True
+        state.decelerate = False
+    else:
+        log.debug("UP/DOWN released")
+        state.accelerate = False
+        state.decelerate = True
+
+def _noop(fvalue, state):
+    pass
+
+# Dispatch tables: button/axis name -> handler
+BTN_PRESS = {"thumb": _do_accel, "thumb2": _do_decel, "base4": _do_exit}
+BTN_RELEASE = {"thumb": _release_accel, "thumb2": _release_decel}
+AXIS_HANDLERS = {"x": _on_x, "y": _on_y}
 
 # SIGINT Handler
-def sig_handler(signum, frame):
-    print("SIGINT")
-    event.set()
-    time.sleep(0.4)
-    sys.exit(0)
-
-def js_thread(out_queue, event):
-    while not event.is_set():
-        evbuf = jsdev.read(8)
-        if evbuf:
-            print("SENDING js event")
-            out_queue.put(evbuf)
-    print("Stopping js event processing")
-    jsdev.close()
+def sig_handler(state):
+    log.info("SIGINT")
+    state.stop_event.set()
+
+# Joystick fd is readable: drain every pending event in one wake
+def _on_js_readable(jsdev_fd, state):
+    # bind the globals used for every event as locals (LOAD_FAST in the loops below)
+    _read = os.read
+    _bmap = button_map
+    _amap = axis_map
+    _lut = AXIS_LUT
+    _button = _on_button
+    _axis = _on_axis
+
+    chunks = []
+    while True:
+        try:
+            buf = _read(jsdev_fd, READ_SIZE)
+        except BlockingIOError:
+            break
+        except OSError as err:
+            # e.g. ENODEV when the joystick is unplugged
+            log.error("Joystick disconnected: %s", err)
+            asyncio.get_running_loop().remove_reader(jsdev_fd)
+            state.stop_event.set()
+            break
+        if not buf:
+            # EOF: the device is gone, stop instead of spinning on a readable fd
+            log.error("Joystick disconnected")
+            asyncio.get_running_loop().remove_reader(jsdev_fd)
+            state.stop_event.set()
+            break
+
+        chunks.append(buf)
+
+    data = b''.join(chunks)
+    # joydev only returns whole js_events, so a single length check per burst is enough
+    if len(data) % EV_STRUCT.size:
+        log.warning("bad event: dropping %d trailing bytes", len(data) % EV_STRUCT.size)
+        data = data[:len(data) - len(data) % EV_STRUCT.size]
+
+    # checked once per burst so no formatting happens unless DEBUG is enabled
+    debug = log.isEnabledFor(logging.DEBUG)
+    for time_val, value, type, number in EV_UNPACK(data):
+        if debug and type & 0x80:
+            log.debug("(initial)")
+
+        if type & 0x01:
+            if number >= len(_bmap):
+                log.warning("bad event: unknown button %d", number)
+                continue
+            button = _bmap[number]
+            if button:
+                _button(button, value, state, debug)
+
+        if type & 0x02:
+            if number >= len(_amap):
+                log.warning("bad event: unknown axis %d", number)
+                continue
+            axis = _amap[number]
+            if axis:
+                _axis(axis, _lut[value + 32768], state, debug)
+
+# evdev device is readable: same as above, for /dev/input/event* devices
+def _on_evdev_readable(dev, state):
+    debug = log.isEnabledFor(logging.DEBUG)
+    try:
+        for ev in dev.read():
+            if ev.type == ecodes.EV_KEY:
+                button = evdev_buttons.get(ev.code)
+                # value 2 is the autorepeat of a held key
+                if button and ev.value != 2:
+                    _on_button(button, ev.value, state, debug)
+            elif ev.type == ecodes.EV_ABS:
+                axis = evdev_axes.get(ev.code)
+                if axis:
+                    axis_name, minimum, span = axis
+                    _on_axis(axis_name, 2.0 * (ev.value - minimum) / span - 1.0, state, debug)
+    except BlockingIOError:
+        pass
+    except OSError as err:
+        log.error("Joystick disconnected: %s", err)
+        asyncio.get_running_loop().remove_reader(dev.fd)
+        state.stop_event.set()
+
+def _on_button(button, value, state, debug):
+    button_states[button] = value
+    if debug:
+        log.debug(f"{button} {'pressed' if value else 'released'}")
+    handler = (BTN_PRESS if value else BTN_RELEASE).get(button)
+    if handler:
+        handler(state)
+
+def _on_axis(axis, fvalue, state, debug):
+    axis_states[axis] = fvalue
+    if debug:
+        log.debug(f"{axis}: {fvalue:.3f}")
+    AXIS_HANDLERS.get(axis, _noop)(fvalue, state)
+
+# Periodic control tick: recompute speed/lane and send the coalesced commands
+def _tick_control(state):
+    if state.stop_event.is_set():
+        return
+
+    now = time.monotonic()
+    dt = now - state.last_tick
+    state.last_tick = now
+
+    debug = log.isEnabledFor(logging.DEBUG)
+    # nothing left to ramp once max speed is reached
+    if state.accelerate and state.current_speed < state.max_speed:
+        # exact discretization of a first-order lag towards max_speed
+        state.current_speed += (state.max_speed - state.current_speed) * (1 - math.exp(-dt / TAU_ACCEL))
+        # snap to the asymptote instead of creeping towards it
+        if state.max_speed - state.current_speed < 1:
+            state.current_speed = state.max_speed
+        if debug:
+            log.debug(f"ACCELERATING: {state.current_speed}")
+
+    if state.decelerate and state.current_speed > 0:
+        state.current_speed *= math.exp(-dt / TAU_DECEL)
+        if state.current_speed <= 200:
+            state.current_speed = 0
+        if debug:
+            log.debug(f"DECELERATING: {state.current_speed}")
+
+    if state.left:
+        if state.current_lane > -LANE_LIMIT:
+            state.current_lane = max(state.current_lane - LANE_RATE * dt, -LANE_LIMIT)
+            if debug:
+                log.debug(f"LEFT: {state.current_lane}")
+
+    if state.right:
+        if state.current_lane < LANE_LIMIT:
+            state.current_lane = min(state.current_lane + LANE_RATE * dt, LANE_LIMIT)
+            if debug:
+                log.debug(f"RIGHT: {state.current_lane}")
+
+    # publish the latest speed/lane, the commander thread does the actual sending
+    desired = (int(state.current_speed), int(state.current_lane))
+    if desired != state.desired:
+        state.desired = desired
+        state.desired_ev.set()
+
+    asyncio.get_running_loop().call_later(TICK_INTERVAL, _tick_control, state)
+
+# Commands needed to bring the car from the last sent (speed, lane) to the desired one
+def _commands_for(desired, sent):
+    speed, lane = desired
+    last_speed, last_lane = sent
+    commands = []
+    if lane != last_lane:
+        commands.append(('lane', speed, lane))
+    # change_lane (0x25) does not set the forward speed: send it on its own, even in the
+    # same slot as a lane change
+    if speed != last_speed:
+        commands.append(('speed', speed, lane))
+    return commands
+
+# Commander thread: send the latest desired speed/lane to the car at most every MIN_TX_INTERVAL.
+# Overdrive calls only enqueue to the SDK send thread, so this is about what gets sent (latest
+# wins, stale intermediate values are dropped) and how often, not about blocking the loop.
+def commander(state):
+    sent = state.desired
+    # bound once: the car object is never replaced (Overdrive.reconnect() re-uses it)
+    change_speed = state.car.change_speed
+    change_lane = state.car.change_lane
+    wait = state.desired_ev.wait
+    clear = state.desired_ev.clear
+    stopped = state.stop_event.is_set
+    sleep = time.sleep
+    while not stopped():
+        if not wait(0.5):
+            continue
+        clear()
+        desired = state.desired
+        for kind, speed, lane in _commands_for(desired, sent):
+            if kind == 'lane':
+                change_lane(speed, 2000, lane)
+            else:
+                change_speed(speed, 2000)
+        sent = desired
+        # bound gateway traffic: updates arriving meanwhile collapse into the mailbox
+        sleep(MIN_TX_INTERVAL)
 
 # Main event loop
-def consumer(in_queue, event):
-    current_speed = 400
-    current_lane = 0.0
+async def main():
+    loop = asyncio.get_running_loop()
+    state = DriveState(stop_event=asyncio.Event())
+    loop.add_signal_handler(signal.SIGINT, sig_handler, state)
 
     # let's drive!
 
     # init overdrive object
-    print("Waiting for node Gateway")
-    time.sleep(1)
-    print("Starting overdrive object")
-    car = Overdrive(args.host, args.port, args.car)
-    #car.change_speed(current_speed, 2000)  # set car speed with speed = 400, acceleration = 2000
-
-    max_speed = 3000
-    accelerate = False
-    decelerate = False
-    left = False
-    right = False
-
-    while not event.is_set():
-        sys.stdout.flush()
-        try:
-            if not in_queue.empty():
-                evbuf = in_queue.get(True, 0.2)
-                in_queue.task_done()
-                if evbuf:
-                    time_val, value, type, number = struct.unpack('IhBB', evbuf)
-
-                    if type & 0x80:
-                        print("(initial)", end="")
-
-                    if type & 0x01:
-                        button = button_map[number]
-                        if button:
-                            button_states[button] = value
-                            if value:
-                                print("%s pressed" % (button))
-                                if button == "thumb":
-                                    accelerate = True
-                                    decelerate = False
-                                elif button == "thumb2":
-                                    accelerate = False
-                                    decelerate = True
-                                elif button == "base4":
-                                    print("Exiting due to keypress. Disconnecting car")
-                                    try:
-                                        del car
-                                    except BaseException as err:
-                                        print("Error deleting car object: {0}".format(err))
-                                    print("Setting ThreadPoolExecutor Event")
-                                    event.set()
-                                    return
-                                    #os.kill(os.getpid(), signal.SIGINT)
-                                    #return
-                            else:
-                                print("%s released" % (button))
-                                if button == "thumb":
-                                    accelerate = False
-                                    decelerate = True
-                                elif button == "thumb2":
-                                    accelerate = False
-                                    decelerate = True
-
-                    if type & 0x02:
-                        axis = axis_map[number]
-                        if axis:
-                            fvalue = value / 32767.0
-                            axis_states[axis] = fvalue
-                            print("%s: %.3f" % (axis, fvalue))
-                            if axis == "x" and fvalue<=-1.0:
-                                left=True
-                                right = False
-                            elif axis == "x" and fvalue>=1.0:
-                                right = True
-                                left = False
-                            elif axis == "y":
-                                if fvalue >= 0.9:
-                                    print("DOWN")
-                                    accelerate = False
-                                    decelerate = True
-                                elif fvalue <= -0.9:
-                                    print("UP")
-                                    accelerate = True
-                                    decelerate = False
-                                else:
-                                    print("UP/DOWN released")
-                                    accelerate = False
-                                    decelerate = True
-                
-            else:
-                time.sleep(0.2)
-
-            if accelerate:
-                current_speed += (max_speed - current_speed) / 4
-                if current_speed >= max_speed:
-                    current_speed = max_speed
-                print("ACCELERATING: %s" %current_speed)
-                car.change_speed(int(current_speed), 2000)
-        
-            if decelerate:
-                current_speed -= current_speed / 3
-                if current_speed <= 200:
-                    current_speed = 0
-                print("DECELERATING: %s" %current_speed)
-                car.change_speed(int(current_speed), 2000)
-            
-            if left:
-                if current_lane >= -100:
-                    current_lane -= 30.0
-                    print("LEFT: %s" %current_lane)
-                    car.change_lane(int(current_speed), 2000, int(current_lane))
-
-            if right:
-                if current_lane <= 100:
-                    current_lane += 30.0
-                    print("RIGHT: %s" %current_lane)
-                    car.change_lane(int(current_speed), 2000, int(current_lane))
-
-        except ValueError:
-            print("Unexpected error:", sys.exc_info()[0])
-
-    print("Disconnecting car")
-    del car
-    print("EXIT")
-
-
-signal.signal(signal.SIGINT, sig_handler)
+    log.info("Waiting for node Gateway")
+    await asyncio.sleep(1)
+    log.info("Starting overdrive object")
+    state.car = Overdrive(args.host, args.port, args.car)
+    #state.car.change_speed(current_speed, 2000)  # set car speed with speed = 400, acceleration = 2000
+
+    # joystick events are read on the loop itself, no reader thread or queue needed
+    if isinstance(jsdev, int):
+        loop.add_reader(js_fd, _on_js_readable, js_fd, state)
+    else:
+        loop.add_reader(js_fd, _on_evdev_readable, jsdev, state)
+    state.last_tick = time.monotonic()
+    loop.call_soon(_tick_control, state)
+    commander_thread = threading.Thread(target=commander, args=(state,), daemon=True)
+    commander_thread.start()
+
+    await state.stop_event.wait()
+
+    log.info("Disconnecting car")
+    state.desired_ev.set()
+    commander_thread.join()
+    loop.remove_reader(js_fd)
+    if isinstance(jsdev, int):
+        os.close(jsdev)
+    else:
+        jsdev.close()
+    # stop the car before releasing it, disconnect() sends the pending commands first
+    state.car.change_speed(0, 2000)
+    state.car.disconnect()
+    log.info("EXIT")
+
 
 # Start
-pipeline = queue.Queue(maxsize=10)
-event = threading.Event()
-with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-    executor.submit(js_thread, pipeline, event)
-    executor.submit(consumer, pipeline, event)
+asyncio.run(main())
@@ -6,12 +6,14 @@
     The code is released under the Apache License 2.0:  FOR FULL LICENSE AND MORE INFO, PLEASE SEE README
 """
 
+import atexit
 import struct
 import threading
 import socket
 import time
 from datetime import datetime
-from queue import Queue, Empty
+from collections import deque
+from queue import SimpleQueue, Empty
 
 
 class Overdrive:
@@ -25,17 +27,23 @@ class Overdrive:
         :param driving_policy: optional function supplied by the user to take action based on location events
         """
         # init node socket
-        self.node_socket = socket.socket()
-        self.node_socket.connect((host, port))
+        self._host = host
+        self._port = port
+        self._open_socket()
         # set some class variables
         self.uuid = uuid
         self._connected = False
         # store queues
         self._queues = {
-            'commands': Queue(),  # queue to write commands to the gateway
-            'locations': Queue()  # queue to write location events received from the gateway
+            'commands': SimpleQueue(),  # queue to write commands to the gateway
+            # location events received from the gateway: bounded, drops the oldest events if the
+            # driving policy falls behind so that it always works on the newest position
+            'locations': deque(maxlen=64)
         }
+        self._location_ready = threading.Event()
         self._threads = []
+        # bumped by reconnect(): worker threads of an older connection see it and exit
+        self._generation = 0
         # driving policy supplied by the user overwrite the standard one in _standard_driving_policy
         self._driving_policy = driving_policy
         # init current speed at 0
@@ -44,16 +52,88 @@ class Overdrive:
         self._verbose = verbose
         # finally try to connect to the car through node socket
         self._connect(self.uuid)
+        # the worker threads are daemons and keep this object alive, so __del__ would never run:
+        # make sure the vehicle is released on the gateway when the script exits
+        atexit.register(self.disconnect)
         return
 
     def __del__(self):
-        self._connected = False
-        self._disconnect(self.uuid)
+        # __init__ may have failed before the connection was set up
+        if getattr(self, '_connected', False):
+            self.disconnect()
 
     """
         CONNECTION FUNCTIONS
     """
 
+    def _open_socket(self):
+        self.node_socket = socket.create_connection((self._host, self._port))
+        # commands are a few bytes each: send them right away instead of waiting for Nagle
+        self.node_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _close_socket(self):
+        try:
+            # wakes up the read thread blocked on recv
+            self.node_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.node_socket.close()
+
+    def reconnect(self):
+        """
+        Re-open the socket to the node gateway and connect again to the same vehicle, re-using this
+        object (host, port, uuid, queues and driving policy) instead of building a new one
+
+        :return:
+        """
+        try:
+            # send what was already queued on the old connection, so no command is dropped
+            self._stop_sender()
+            # release the vehicle on the gateway side, it has no handler for a closed client
+            self._disconnect(self.uuid)
+        except OSError:
+            # the old socket is dead: commands still in the queue go out on the new connection
+            pass
+        self._close_socket()
+        for thread in self._threads:
+            # reconnect may be called from the driving policy, i.e. from one of our own threads
+            if thread is not threading.current_thread():
+                # it will exit on its own once the driving policy returns, see _is_current
+                thread.join()
+        self._threads = []
+        self._open_socket()
+        self._connect(self.uuid)
+
+    def disconnect(self):
+        """
+        Send the pending commands, disconnect the vehicle from the node gateway and close the socket
+
+        :return:
+        """
+        if not self._connected:
+            return
+        self._stop_sender()
+        self._disconnect(self.uuid)
+        self._close_socket()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._threads = []
+
+    def _stop_sender(self):
+        # stop the worker threads of the current connection, then flush what is left in the
+        # command queue ourselves on the still open socket
+        self._connected = False
+        self._generation += 1
+        if self._sender is not threading.current_thread():
+            self._sender.join()
+        try:
+            while True:
+                data = self._queues['commands'].get_nowait()
+                self.node_socket.send('{}\n'.format(data.hex()).encode())
+        except Empty:
+            pass
+
     def _disconnect(self, uuid):
         self.node_socket.send("DISCONNECT|{}\n".format(uuid).encode())
 
@@ -61,7 +141,7 @@ class Overdrive:
         self._send_connect_message_to_socket(uuid)
         self._connected = True
         # fork thread to read and write to the bluetooth socket
-        self._start_thread(self._send_thread)
+        self._sender = self._start_thread(self._send_thread)
         self._start_thread(self._read_thread)
         self._start_thread(self._location_changed_thread)
         self.turn_on_sdk_mode()
@@ -81,48 +161,70 @@ class Overdrive:
     """
 
     def _start_thread(self, target_function):
-        new_thread = threading.Thread(target=target_function)
+        # daemon threads: they loop for the whole life of the connection and must not keep
+        # the interpreter alive once the calling script is done
+        new_thread = threading.Thread(target=target_function, daemon=True)
         self._threads.append(new_thread)
         new_thread.start()
+        return new_thread
+
+    def _is_current(self, generation):
+        # True while the thread started for connection `generation` should keep on running
+        return self._connected and generation == self._generation
 
     def _read_thread(self):
-        while self._connected:
-            data = self.node_socket.recv(1024).decode()
+        generation = self._generation
+        while self._is_current(generation):
+            try:
+                data = self.node_socket.recv(1024).decode()
+            except OSError:
+                # socket closed by reconnect/disconnect: exit quietly
+                if not self._is_current(generation):
+                    break
+                raise
             if data:
                 b_data = bytes.fromhex(data)
                 command_id = hex(struct.unpack_from("B", b_data, 1)[0])
                 self._handle_notification(command_id, b_data)
 
     def _send_thread(self):
-        while self._connected:
+        generation = self._generation
+        while self._is_current(generation):
             try:
-                data = self._queues['commands'].get_nowait()
+                # block with a timeout instead of spinning, so we can still notice a disconnect
+                data = self._queues['commands'].get(timeout=0.05)
                 self.node_socket.send('{}\n'.format(data.hex()).encode())
-            except Empty as empty_ex:
+            except Empty:
                 continue
-            except Exception as ex:
-                raise ex
+            except OSError:
+                # socket closed by reconnect/disconnect: exit quietly
+                if not self._is_current(generation):
+                    break
+                raise
 
     def _location_changed_thread(self):
-        while self._connected:
-            try:
-                (location, piece, offset, speed, clockwise, notification_time) = self._queues['locations'].get_nowait()
+        generation = self._generation
+        locations = self._queues['locations']
+        while self._is_current(generation):
+            if not self._location_ready.wait(0.05):
+                continue
+            self._location_ready.clear()
+            # the policy may call reconnect(): leave the remaining events to the new thread
+            while locations and self._is_current(generation):
+                (location, piece, offset, speed, clockwise, notification_time) = locations.popleft()
                 location_event = self.build_location_event(location, piece, offset, speed, clockwise, notification_time)
                 if self._driving_policy:
                     self._driving_policy(self, **location_event)
                 else:
                     self._standard_driving_policy(**location_event)
-            except Empty as empty_ex:
-                continue
-            except Exception as ex:
-                raise ex
 
     def _handle_notification(self, command_id, data):
         # location notification
         if command_id == '0x27':
             # parse location
             location, piece, offset, speed, clockwise = struct.unpack_from("<BBfHB", data, 2)
-            self._queues['locations'].put((location, piece, offset, speed, clockwise, datetime.utcnow()))
+            self._queues['locations'].append((location, piece, offset, speed, clockwise, datetime.utcnow()))
+            self._location_ready.set()
         # transition notification
         elif command_id == '0x29':
             # piece, piecePrev, offset, direction = struct.unpack_from("<BBfB", data, 2)